@@ -1,25 +1,37 @@
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse, Response
 from pydantic import BaseModel, Field
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Set
 import requests # type: ignore
 import time
 import re
+import secrets
+import random
+import os
+import sys
+import hmac
+import psutil
+import itertools
 from threading import Lock
-from datetime import datetime, timedelta
-import concurrent.futures
+from collections import OrderedDict, deque
+from datetime import datetime
 import asyncio
-import json
+import orjson
 import uvicorn
-import asyncio
 import functools
+import logging
+
+logger = logging.getLogger("techstats")
 
 app = FastAPI(
     title="TechStats API",
     description="API для анализа технологий в вакансиях с HH.ru",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url=None  # Отключаем ReDoc
+    redoc_url=None,  # Отключаем ReDoc
+    # orjson вместо jsonable_encoder + stdlib json для всех REST-ответов
+    default_response_class=ORJSONResponse
 )
 
 # CORS настройки
@@ -37,43 +49,218 @@ REQUEST_DELAY = 0.1
 MAX_REQUESTS_PER_SECOND = 7
 HH_API_BASE_URL = "https://api.hh.ru"
 CACHE_TTL_HOURS = 24  # Время жизни кэша в часах
+MAX_CACHE_ENTRIES = 10000  # Максимум записей в кэше описаний (LRU-вытеснение)
+PROGRESS_MIN_INTERVAL = 0.2  # Минимальный интервал между кадрами прогресса (сек)
+CACHE_SWEEP_INTERVAL = 3600  # Базовый интервал фоновой чистки кэша (сек)
+MAX_CONCURRENT_ANALYSES = 4  # Одновременно выполняемых анализов на процесс
+
+# Токен для административных операций; кодируется один раз при старте,
+# а не на каждый запрос. Пустое значение = проверка отключена
+_ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "").encode()
+
+def verify_admin_token(authorization: Optional[str] = Header(None)):
+    """Проверяет админ-токен, если он задан через переменную окружения ADMIN_TOKEN"""
+    if not _ADMIN_TOKEN:
+        return
+    supplied = (authorization or "").removeprefix("Bearer ").encode()
+    # compare_digest: сравнение за константное время (реализовано на C),
+    # обычный != дает тайминг-оракул по длине/префиксу токена
+    if not hmac.compare_digest(supplied, _ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Недействительный админ-токен")
+
+# Общая HTTP-сессия с keep-alive: повторные запросы к HH API переиспользуют
+# TCP/TLS-соединения из пула вместо нового рукопожатия на каждый вызов.
+# Целочисленный max_retries повторяет только неудачные соединения
+# (DNS/connect), но не запросы, уже дошедшие до сервера
+http_session = requests.Session()
+_http_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=MAX_WORKERS * 4,
+    max_retries=1
+)
+http_session.mount("https://", _http_adapter)
+http_session.mount("http://", _http_adapter)
 
 # Глобальные счетчики и кэш
 request_counter = 0
 cached_requests_counter = 0
-counter_lock = Lock()
-last_request_time = time.time()
-rate_limit_lock = Lock()
+last_request_time = time.monotonic()
 
 # Улучшенный кэш с временными метками
 class CacheEntry:
-    def __init__(self, data: str, timestamp: datetime):
+    # __slots__: без __dict__ каждая запись кэша занимает в разы меньше
+    # памяти, а доступ к полям идет по фиксированному смещению, не по хэшу
+    __slots__ = ("data", "timestamp")
+
+    def __init__(self, data: str, timestamp: float):
         self.data = data
-        self.timestamp = timestamp
-    
+        self.timestamp = timestamp  # time.monotonic() на момент записи
+
     def is_expired(self, ttl_hours: int = CACHE_TTL_HOURS) -> bool:
-        return datetime.now() - self.timestamp > timedelta(hours=ttl_hours)
+        # Монотонные часы не подвержены скачкам NTP/переводу времени,
+        # поэтому TTL не может сработать ложно из-за сдвига wall clock
+        return time.monotonic() - self.timestamp > ttl_hours * 3600
 
-description_cache: Dict[str, CacheEntry] = {}
+# OrderedDict используется как LRU: без ограничения размера кэш растет
+# бесконечно на долгоживущем процессе
+description_cache: "OrderedDict[str, CacheEntry]" = OrderedDict()
 cache_lock = Lock()
 
+MAX_OUTBOUND_FRAMES = 100  # Максимум кадров в исходящей очереди одного соединения
+
+class OutboundQueue:
+    """Ограниченная исходящая очередь одного websocket-соединения.
+
+    Кадры прогресса помечаются droppable: при переполнении очереди самый
+    старый из них выбрасывается, а важные кадры (результат, ошибки)
+    сохраняются всегда. Так медленный клиент замедляет только себя,
+    а не цикл анализа.
+    """
+    __slots__ = ("frames", "wakeup", "writer_task", "dropped", "in_flight")
+
+    def __init__(self):
+        self.frames = deque()  # элементы: (payload: str, droppable: bool)
+        self.wakeup = asyncio.Event()
+        self.writer_task: Optional[asyncio.Task] = None
+        self.dropped = 0
+        self.in_flight = False  # Писатель отправляет уже извлеченный кадр
+
+    def enqueue(self, payload: str, droppable: bool):
+        frames = self.frames
+        if droppable and len(frames) >= MAX_OUTBOUND_FRAMES:
+            # Выбрасываем самый старый droppable-кадр, чтобы освободить место
+            for i, (_, frame_droppable) in enumerate(frames):
+                if frame_droppable:
+                    del frames[i]
+                    self.dropped += 1
+                    break
+        frames.append((payload, droppable))
+        self.wakeup.set()
+
 # Активные WebSocket соединения
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
+        # Соль процесса + монотонный счетчик дают уникальные id
+        # без затрат на uuid4 при каждом подключении
+        self._proc_salt = secrets.token_hex(4)
+        self._conn_seq = 0
+        # Счетчик принятых соединений поддерживается на лету:
+        # статистика читается за O(1), без обхода соединений
+        self._total_accepted = 0
+        # Исходящие очереди соединений: отправка не блокирует цикл анализа
+        self.outbound_queues: Dict[WebSocket, OutboundQueue] = {}
+        # Целочисленные счетчики кадров вместо списков результатов отправки:
+        # статистика доставки читается за O(1) и не создает мусора
+        self._frames_sent = 0
+        self._frames_dropped = 0
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket) -> str:
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
+        self._conn_seq += 1
+        self._total_accepted += 1
+        connection_id = f"conn_{self._proc_salt}{self._conn_seq:08x}"
+        queue = OutboundQueue()
+        self.outbound_queues[websocket] = queue
+        queue.writer_task = asyncio.create_task(self._writer(websocket, queue))
+        return connection_id
+
+    async def _writer(self, websocket: WebSocket, queue: OutboundQueue):
+        """Единственная задача, пишущая в сокет: разбирает очередь по порядку"""
+        frames = queue.frames
+        try:
+            while True:
+                if not frames:
+                    queue.wakeup.clear()
+                    await queue.wakeup.wait()
+                    continue
+                payload, _ = frames.popleft()
+                queue.in_flight = True
+                await websocket.send_text(payload)
+                queue.in_flight = False
+                self._frames_sent += 1
+        except Exception:
+            # Разрыв соединения: очередь и задачу уберет disconnect()
+            pass
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        # discard вместо "in + remove": один поиск по хэшу и идемпотентность
+        self.active_connections.discard(websocket)
+        queue = self.outbound_queues.pop(websocket, None)
+        if queue is not None:
+            self._frames_dropped += queue.dropped
+            if queue.writer_task is not None:
+                queue.writer_task.cancel()
+
+    def active_count(self) -> int:
+        # len() множества - O(1), без обхода соединений
+        return len(self.active_connections)
 
-    async def send_message(self, message: dict, websocket: WebSocket):
-        await websocket.send_json(message)
+    def stats(self) -> Dict[str, int]:
+        """Счетчики соединений; только чтение готовых целых"""
+        # Счетчики живых очередей добавляются к накопленным от закрытых
+        dropped = self._frames_dropped + sum(q.dropped for q in self.outbound_queues.values())
+        return {
+            "active": self.active_count(),
+            "total_accepted": self._total_accepted,
+            "frames_sent": self._frames_sent,
+            "frames_dropped": dropped
+        }
+
+    async def close(self, websocket: WebSocket, code: int = 1000):
+        """Закрывает сокет с таймаутом и чистит состояние.
+
+        Без таймаута зависший клиент мог бы держать обработчик на
+        websocket.close() неограниченно долго.
+        """
+        # Даем писателю шанс дослать накопленные кадры (результат, ошибки),
+        # включая кадр, уже извлеченный из очереди и отправляемый прямо сейчас
+        queue = self.outbound_queues.get(websocket)
+        if queue is not None:
+            deadline = time.monotonic() + 5.0
+            while (queue.frames or queue.in_flight) and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+        try:
+            await asyncio.wait_for(websocket.close(code=code), timeout=2.0)
+        except Exception:
+            pass
+        self.disconnect(websocket)
+
+    async def send_message(self, message: dict, websocket: WebSocket, droppable: bool = False):
+        # orjson (C-расширение) вместо stdlib json в send_json:
+        # кодирование сообщений прогресса в разы дешевле
+        await self.send_payload(orjson.dumps(message).decode(), websocket, droppable)
+
+    async def send_payload(self, payload: str, websocket: WebSocket, droppable: bool = False):
+        """Отправка уже закодированного кадра - для статических сообщений,
+        закодированных один раз при импорте"""
+        queue = self.outbound_queues.get(websocket)
+        if queue is None:
+            # Сокет не зарегистрирован (уже отключен) - отправляем напрямую
+            await websocket.send_text(payload)
+            return
+        queue.enqueue(payload, droppable)
 
 manager = ConnectionManager()
 
+# Неизменные кадры кодируются один раз при импорте, а не на каждую отправку
+_QUEUE_WAIT_PAYLOAD = orjson.dumps({
+    "stage": "fetching_vacancies",
+    "message": "Ожидаем очередь: сервер выполняет другие анализы...",
+    "progress": 0
+}).decode()
+_NO_VACANCIES_PAYLOAD = orjson.dumps({
+    "stage": "error",
+    "message": "Вакансии не найдены",
+    "progress": 0
+}).decode()
+
+# Ограничитель одновременных анализов: каждый анализ держит цепочку
+# запросов к HH API и память под список вакансий, без потолка несколько
+# агрессивных клиентов исчерпали бы пул соединений и rate limit
+analysis_semaphore = asyncio.Semaphore(MAX_CONCURRENT_ANALYSES)
+
 # Модели данных
 class GlobalSettings(BaseModel):
     max_workers: int = Field(default=MAX_WORKERS, ge=1, le=10, description="Количество параллельных потоков")
@@ -109,42 +296,113 @@ class AnalysisResult(BaseModel):
     request_stats: Dict
 
 # Утилиты для работы с API
-async def increment_request_counter(use_cache=False):
-    global request_counter, cached_requests_counter, last_request_time
-    
-    with counter_lock:
-        if use_cache:
-            cached_requests_counter += 1
-            return
-        else:
-            request_counter += 1
-            current_time = time.time()
-            
-            with rate_limit_lock:
-                time_since_last_request = current_time - last_request_time
-                if time_since_last_request < (1.0 / MAX_REQUESTS_PER_SECOND):
-                    sleep_time = (1.0 / MAX_REQUESTS_PER_SECOND) - time_since_last_request
-                    await asyncio.sleep(sleep_time)
+async def increment_request_counter():
+    """Учитывает реальный запрос к HH API и выдерживает rate limit"""
+    global request_counter, last_request_time
+
+    # Счетчики меняются только из event loop, поэтому блокировки не нужны:
+    # между чтением и записью нет await, инкременты атомарны для задач
+    request_counter += 1
 
-                last_request_time = time.time()
+    # Rate limiting: синхронно резервируем слот времени и только потом спим,
+    # чтобы не держать блокировку (и весь event loop) во время ожидания
+    min_interval = 1.0 / MAX_REQUESTS_PER_SECOND
+    now = time.monotonic()
+    slot = max(now, last_request_time + min_interval)
+    last_request_time = slot
+    if slot > now:
+        await asyncio.sleep(slot - now)
 
 def get_request_count():
-    with counter_lock:
-        return request_counter, cached_requests_counter
+    # Чтение пары целых в одном выражении атомарно для задач event loop
+    return request_counter, cached_requests_counter
 
 def reset_request_counters():
     global request_counter, cached_requests_counter
-    with counter_lock:
-        request_counter = 0
-        cached_requests_counter = 0
+    request_counter = 0
+    cached_requests_counter = 0
+
+def evict_expired_entries() -> tuple:
+    """Один проход по кэшу: удаляет устаревшие записи и считает агрегаты.
+
+    Возвращает (размер кэша, сколько записей истечет в ближайший час).
+    """
+    now = time.monotonic()
+    ttl_seconds = CACHE_TTL_HOURS * 3600
+    near_ttl_seconds = (CACHE_TTL_HOURS - 1) * 3600
+
+    with cache_lock:
+        expired_keys = []
+        expiring_soon = 0
+        for key, entry in description_cache.items():
+            age = now - entry.timestamp
+            if age > ttl_seconds:
+                expired_keys.append(key)
+            elif age > near_ttl_seconds:
+                expiring_soon += 1
+        for key in expired_keys:
+            del description_cache[key]
+        return len(description_cache), expiring_soon
+
+def cache_description(vacancy_id: str, description: str):
+    """Сохраняет описание в кэш, вытесняя самые старые записи при переполнении"""
+    with cache_lock:
+        description_cache[vacancy_id] = CacheEntry(description, time.monotonic())
+        description_cache.move_to_end(vacancy_id)
+        while len(description_cache) > MAX_CACHE_ENTRIES:
+            description_cache.popitem(last=False)
+
+async def cache_sweeper():
+    """Фоновая чистка устаревших записей кэша.
+
+    Интервал берется со случайным разбросом +/-25%, чтобы несколько
+    воркеров не запускали чистку синхронно; при пустом кэше проход
+    пропускается.
+    """
+    while True:
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL * (0.75 + random.random() * 0.5))
+        if not description_cache:
+            continue
+        cache_size, _ = evict_expired_entries()
+        logger.debug("Фоновая чистка кэша завершена, записей осталось: %s", cache_size)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    app.state.cache_sweeper_task = asyncio.create_task(cache_sweeper())
+
+async def _stop_cache_sweeper():
+    task = app.state.cache_sweeper_task
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    # Явная отмена с ожиданием: фоновая задача завершается внутри штатного
+    # shutdown uvicorn, а не обрывается вместе с event loop.
+    # Независимые шаги закрытия идут параллельно (время = максимум, а не
+    # сумма), shield не дает отмене самого shutdown оставить пул соединений
+    # полузакрытым
+    await asyncio.shield(asyncio.gather(
+        _stop_cache_sweeper(),
+        asyncio.to_thread(http_session.close),
+        return_exceptions=True
+    ))
 
 async def get_vacancy_description_cached(vacancy_id: str) -> str:
     """Получение описания вакансии с проверкой актуальности кэша"""
     with cache_lock:
-        if vacancy_id in description_cache:
-            cache_entry = description_cache[vacancy_id]
+        # get() вместо "in + [] ": один поиск по хэшу вместо двух
+        cache_entry = description_cache.get(vacancy_id)
+        if cache_entry is not None:
             if not cache_entry.is_expired():
-                await increment_request_counter(use_cache=True)
+                description_cache.move_to_end(vacancy_id)  # Обновляем LRU-порядок
+                # Попадание в кэш - простой инкремент на месте, без вызова
+                # корутины и rate limiter на быстром пути
+                global cached_requests_counter
+                cached_requests_counter += 1
                 return cache_entry.data
             else:
                 # Удаляем устаревшую запись
@@ -152,23 +410,22 @@ async def get_vacancy_description_cached(vacancy_id: str) -> str:
     
     try:
         url = f"{HH_API_BASE_URL}/vacancies/{vacancy_id}"
-        response = await asyncio.to_thread(functools.partial(requests.get, url, timeout=10))
-        await increment_request_counter(use_cache=False)
+        # Слот rate limiter резервируется до отправки запроса - иначе
+        # параллельные задачи успевают выстрелить пачкой до ожидания
+        await increment_request_counter()
+        response = await asyncio.to_thread(functools.partial(http_session.get, url, timeout=10))
         response.raise_for_status()
         data = response.json()
         description = data.get('description', '')
-        
-        with cache_lock:
-            description_cache[vacancy_id] = CacheEntry(description, datetime.now())
-        
+        cache_description(vacancy_id, description)
         return description
     except:
-        with cache_lock:
-            description_cache[vacancy_id] = CacheEntry("", datetime.now())
+        cache_description(vacancy_id, "")
         return ""
 
-async def fetch_single_page(search_text: str, area: int, per_page: int, page: int) -> List[Dict]:
-    params = {
+def build_search_params(search_text: str, area: int, page: int, per_page: int = 100) -> Dict:
+    """Собирает параметры запроса поиска вакансий к HH API"""
+    return {
         'text': search_text,
         'search_field': 'name',
         'area': area,
@@ -176,9 +433,14 @@ async def fetch_single_page(search_text: str, area: int, per_page: int, page: in
         'page': page,
         'only_with_salary': False
     }
-    
-    response = await asyncio.to_thread(functools.partial(requests.get, f"{HH_API_BASE_URL}/vacancies", params=params, timeout=10))
-    await increment_request_counter(use_cache=False)
+
+async def fetch_single_page(search_text: str, area: int, per_page: int, page: int) -> List[Dict]:
+    params = build_search_params(search_text, area, page, per_page)
+
+    # Слот rate limiter резервируется до отправки: страницы чанка уходят
+    # с выдержанным интервалом, а не одновременным залпом
+    await increment_request_counter()
+    response = await asyncio.to_thread(functools.partial(http_session.get, f"{HH_API_BASE_URL}/vacancies", params=params, timeout=10))
     response.raise_for_status()
     data = response.json()
     await asyncio.sleep(REQUEST_DELAY)
@@ -189,7 +451,7 @@ async def get_vacancies_with_progress(search_text: str, area: int, max_pages: in
     """Получение вакансий с отправкой прогресса через WebSocket"""
     reset_request_counters()
     
-    print(f"Начинаем поиск вакансий: {search_text}, область: {area}, макс. страниц: {max_pages}")
+    logger.info("Начинаем поиск вакансий: %s, область: %s, макс. страниц: %s", search_text, area, max_pages)
     
     await manager.send_message({
         "stage": "fetching_vacancies",
@@ -197,18 +459,11 @@ async def get_vacancies_with_progress(search_text: str, area: int, max_pages: in
         "progress": 0
     }, websocket)
     
-    params = {
-        'text': search_text,
-        'search_field': 'name',
-        'area': area,
-        'per_page': 100,
-        'page': 0,
-        'only_with_salary': False
-    }
-    
+    params = build_search_params(search_text, area, page=0)
+
     try:
-        response = await asyncio.to_thread(functools.partial(requests.get, f"{HH_API_BASE_URL}/vacancies", params=params, timeout=10))
-        await increment_request_counter(use_cache=False)
+        await increment_request_counter()
+        response = await asyncio.to_thread(functools.partial(http_session.get, f"{HH_API_BASE_URL}/vacancies", params=params, timeout=10))
         response.raise_for_status()
         data = response.json()
         
@@ -216,7 +471,7 @@ async def get_vacancies_with_progress(search_text: str, area: int, max_pages: in
         found = data.get('found', 0)
         vacancies = data.get('items', [])
         
-        print(f"Получен первый запрос: найдено {found} вакансий, страниц: {total_pages}, загружено: {len(vacancies)}")
+        logger.debug("Получен первый запрос: найдено %s вакансий, страниц: %s, загружено: %s", found, total_pages, len(vacancies))
         
         await manager.send_message({
             "stage": "fetching_vacancies",
@@ -230,33 +485,38 @@ async def get_vacancies_with_progress(search_text: str, area: int, max_pages: in
         
         if total_pages > 1:
             completed_pages = 1
-            pages_to_load = list(range(1, total_pages))
-            
-            # Загружаем страницы последовательно с прогрессом
-            for page in pages_to_load:
-                try:
-                    page_vacancies = await fetch_single_page(search_text, area, 100, page)
+
+            # Загружаем страницы параллельно чанками по MAX_WORKERS:
+            # суммарная задержка = max(страниц в чанке), а не их сумма
+            for chunk_start in range(1, total_pages, MAX_WORKERS):
+                chunk = range(chunk_start, min(chunk_start + MAX_WORKERS, total_pages))
+                results = await asyncio.gather(
+                    *(fetch_single_page(search_text, area, 100, page) for page in chunk),
+                    return_exceptions=True
+                )
+
+                for page, page_vacancies in zip(chunk, results):
+                    if isinstance(page_vacancies, BaseException):
+                        logger.error("Ошибка при загрузке страницы %s: %s", page, page_vacancies)
+                        continue
                     vacancies.extend(page_vacancies)
                     completed_pages += 1
-                    
-                    progress = 10 + (40 * completed_pages / total_pages)
-                    real_requests, cached_requests = get_request_count()
-                    
-                    print(f"Загружена страница {completed_pages}/{total_pages}, всего вакансий: {len(vacancies)}")
-                    
-                    await manager.send_message({
-                        "stage": "fetching_vacancies",
-                        "message": f"Загружено страниц: {completed_pages}/{total_pages}, всего вакансий: {len(vacancies)}",
-                        "progress": int(progress),
-                        "completed_pages": completed_pages,
-                        "total_pages": total_pages,
-                        "loaded_vacancies": len(vacancies),
-                        "real_requests": real_requests,
-                        "cached_requests": cached_requests
-                    }, websocket)
-                    
-                except Exception as e:
-                    print(f"Ошибка при загрузке страницы {page}: {e}")
+
+                progress = 10 + (40 * completed_pages / total_pages)
+                real_requests, cached_requests = get_request_count()
+
+                logger.debug("Загружено страниц %s/%s, всего вакансий: %s", completed_pages, total_pages, len(vacancies))
+
+                await manager.send_message({
+                    "stage": "fetching_vacancies",
+                    "message": f"Загружено страниц: {completed_pages}/{total_pages}, всего вакансий: {len(vacancies)}",
+                    "progress": int(progress),
+                    "completed_pages": completed_pages,
+                    "total_pages": total_pages,
+                    "loaded_vacancies": len(vacancies),
+                    "real_requests": real_requests,
+                    "cached_requests": cached_requests
+                }, websocket, droppable=True)
         
         await manager.send_message({
             "stage": "vacancies_loaded",
@@ -265,14 +525,12 @@ async def get_vacancies_with_progress(search_text: str, area: int, max_pages: in
             "total_vacancies": len(vacancies)
         }, websocket)
         
-        print(f"Всего загружено вакансий: {len(vacancies)}, начинаем анализ")
+        logger.info("Всего загружено вакансий: %s, начинаем анализ", len(vacancies))
         
         return vacancies
         
     except Exception as e:
-        print(f"Ошибка при получении вакансий: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Ошибка при получении вакансий: %s", e)
         await manager.send_message({
             "stage": "error",
             "message": f"Ошибка при получении вакансий: {str(e)}",
@@ -280,53 +538,40 @@ async def get_vacancies_with_progress(search_text: str, area: int, max_pages: in
         }, websocket)
         raise HTTPException(status_code=500, detail=f"Ошибка при получении вакансий: {str(e)}")
 
-async def check_vacancy_for_tech(vacancy: Dict, tech_pattern) -> Dict:
+async def check_vacancy_for_tech(vacancy: Dict, tech_pattern) -> Optional[Dict]:
+    """Возвращает информацию о вакансии, если технология найдена, иначе None"""
     vacancy_id = vacancy.get('id')
     vacancy_name = vacancy.get('name', '')
     vacancy_url = vacancy.get('alternate_url', '')
-    
+
+    # Собираем ответ один раз вместо трех одинаковых литералов по веткам
+    vacancy_info = {
+        'id': vacancy_id,
+        'name': vacancy_name,
+        'url': vacancy_url
+    }
+
     # Проверяем название
     if tech_pattern.search(vacancy_name.lower() if vacancy_name else ""):
-        return {
-            'has_tech': True,
-            'vacancy_info': {
-                'id': vacancy_id,
-                'name': vacancy_name,
-                'url': vacancy_url
-            }
-        }
-    
+        return vacancy_info
+
     # Проверяем сниппет
     snippet = vacancy.get('snippet', {}) or {}
     requirement = snippet.get('requirement', '') or ''
     responsibility = snippet.get('responsibility', '') or ''
     snippet_text = (requirement + " " + responsibility).lower()
-    
+
     if tech_pattern.search(snippet_text):
-        return {
-            'has_tech': True,
-            'vacancy_info': {
-                'id': vacancy_id,
-                'name': vacancy_name,
-                'url': vacancy_url
-            }
-        }
-    
+        return vacancy_info
+
     # Проверяем полное описание
     if not vacancy_id:
-        return {'has_tech': False, 'vacancy_info': None}
+        return None
     description = (await get_vacancy_description_cached(vacancy_id)).lower()
     if tech_pattern.search(description):
-        return {
-            'has_tech': True,
-            'vacancy_info': {
-                'id': vacancy_id,
-                'name': vacancy_name,
-                'url': vacancy_url
-            }
-        }
-    
-    return {'has_tech': False, 'vacancy_info': None}
+        return vacancy_info
+
+    return None
 
 async def analyze_vacancies_with_progress(vacancies: List[Dict], technology: str, websocket: WebSocket) -> Dict:
     """Анализ вакансий с отправкой прогресса"""
@@ -336,7 +581,7 @@ async def analyze_vacancies_with_progress(vacancies: List[Dict], technology: str
     total_vacancies = len(vacancies)
     processed = 0
     
-    print(f"Начинаем анализ {total_vacancies} вакансий на технологию: {technology}")
+    logger.info("Начинаем анализ %s вакансий на технологию: %s", total_vacancies, technology)
     
     await manager.send_message({
         "stage": "analyzing",
@@ -351,40 +596,69 @@ async def analyze_vacancies_with_progress(vacancies: List[Dict], technology: str
     
     # await asyncio.sleep(0.1)
     
+    # Горячий цикл: связываем часто используемые методы в локальные имена,
+    # LOAD_FAST вместо цепочки атрибутных поисков на каждой итерации
+    check_vacancy = check_vacancy_for_tech
+    append_found = tech_vacancies_details.append
+    send_message = manager.send_message
+
+    # Каркас кадра прогресса собирается один раз: неизменные поля не
+    # пересоздаются на каждую отправку, в цикле обновляются только
+    # меняющиеся значения (кадр кодируется в send_message сразу,
+    # поэтому переиспользование словаря безопасно)
+    progress_frame = {
+        "stage": "analyzing",
+        "message": "",
+        "progress": 50,
+        "processed": 0,
+        "total": total_vacancies,
+        "found_with_tech": 0,
+        "real_requests": 0,
+        "cached_requests": 0,
+        "cache_hit_rate": 0.0
+    }
+
+    # Кадры прогресса дополнительно прореживаются по времени: при быстрых
+    # попаданиях в кэш шаг "каждые 10 вакансий" дает сотни кадров в секунду,
+    # из которых браузер все равно успевает отрисовать лишь малую часть.
+    # Последний кадр отправляется всегда
+    monotonic = time.monotonic
+    last_progress_sent = 0.0
+
     # Анализируем вакансии последовательно
     for vacancy in vacancies:
         try:
-            result = await check_vacancy_for_tech(vacancy, tech_pattern)
-            if result['has_tech']:
-                tech_vacancies_details.append(result['vacancy_info'])
-            
+            vacancy_info = await check_vacancy(vacancy, tech_pattern)
+            if vacancy_info is not None:
+                append_found(vacancy_info)
+
             processed += 1
-            
+
             # Отправляем прогресс каждые 10 вакансий или на последней
-            if processed % 10 == 0 or processed == total_vacancies:
+            if (processed % 10 == 0 and monotonic() - last_progress_sent >= PROGRESS_MIN_INTERVAL) \
+                    or processed == total_vacancies:
+                last_progress_sent = monotonic()
                 progress = 50 + (45 * processed / total_vacancies)
                 real_requests, cached_requests = get_request_count()
                 cache_hit_rate = (cached_requests / (real_requests + cached_requests) * 100) if (real_requests + cached_requests) > 0 else 0
                 
-                print(f"Обработано {processed}/{total_vacancies} вакансий. Запросы: {real_requests} реальных, {cached_requests} кэшированных. Кэш: {cache_hit_rate:.1f}% попаданий")
+                logger.debug("Обработано %s/%s вакансий. Запросы: %s реальных, %s кэшированных. Кэш: %.1f%% попаданий", processed, total_vacancies, real_requests, cached_requests, cache_hit_rate)
                 
-                await manager.send_message({
-                    "stage": "analyzing",
-                    "message": f"Обработано вакансий: {processed}/{total_vacancies}, найдено с технологией: {len(tech_vacancies_details)}",
-                    "progress": int(progress),
-                    "processed": processed,
-                    "total": total_vacancies,
-                    "found_with_tech": len(tech_vacancies_details),
-                    "real_requests": real_requests,
-                    "cached_requests": cached_requests,
-                    "cache_hit_rate": round(cache_hit_rate, 1)
-                }, websocket)
+                found = len(tech_vacancies_details)
+                progress_frame["message"] = f"Обработано вакансий: {processed}/{total_vacancies}, найдено с технологией: {found}"
+                progress_frame["progress"] = int(progress)
+                progress_frame["processed"] = processed
+                progress_frame["found_with_tech"] = found
+                progress_frame["real_requests"] = real_requests
+                progress_frame["cached_requests"] = cached_requests
+                progress_frame["cache_hit_rate"] = round(cache_hit_rate, 1)
+                await send_message(progress_frame, websocket, droppable=True)
                 
                 # Даем время браузеру обработать сообщение
                 # await asyncio.sleep(0.05)
                 
         except Exception as e:
-            print(f"Ошибка при анализе вакансии {vacancy.get('id', 'unknown')}: {e}")
+            logger.error("Ошибка при анализе вакансии %s: %s", vacancy.get('id', 'unknown'), e)
             processed += 1
     
     tech_vacancies = len(tech_vacancies_details)
@@ -406,15 +680,26 @@ async def analyze_vacancies_with_progress(vacancies: List[Dict], technology: str
         'tech_vacancies_details': tech_vacancies_details
     }
 
+# Статическая сервисная информация не меняется во время работы -
+# словарь собирается один раз при импорте, а не на каждый запрос
+_SERVICE_INFO = {
+    "service": "TechStats API",
+    "version": "1.0.0",
+    "description": "API для анализа технологий в вакансиях с HH.ru",
+    "docs": "/docs",
+    "python": {
+        "version": sys.version.split()[0],
+        "implementation": sys.implementation.name
+    }
+}
+# Тело ответа сериализуется один раз при импорте; возврат готового Response
+# обходит и повторное кодирование, и jsonable_encoder FastAPI
+_SERVICE_INFO_BODY = orjson.dumps(_SERVICE_INFO)
+
 # Endpoints
 @app.get("/")
 async def root():
-    return {
-        "service": "TechStats API",
-        "version": "1.0.0",
-        "description": "API для анализа технологий в вакансиях с HH.ru",
-        "docs": "/docs"
-    }
+    return Response(content=_SERVICE_INFO_BODY, media_type="application/json")
 
 @app.get("/settings")
 async def get_global_settings():
@@ -426,67 +711,158 @@ async def get_global_settings():
         "cache_ttl_hours": CACHE_TTL_HOURS
     }
 
+# Handle процесса создается один раз; первый вызов cpu_percent "заряжает"
+# измерение, чтобы последующие чтения не возвращали бессмысленный 0.0
+_PROCESS = psutil.Process()
+_PROCESS.cpu_percent(interval=None)
+
+HEALTH_PROBE_TIMEOUT = 2.0  # Короткий таймаут, чтобы зависший HH API не завесил probe
+
+async def check_hh_api():
+    """Проверка доступности HH API"""
+    try:
+        response = await asyncio.to_thread(functools.partial(
+            http_session.get, f"{HH_API_BASE_URL}/vacancies",
+            params={'per_page': 1}, timeout=HEALTH_PROBE_TIMEOUT))
+        return "hh_api", {
+            "status": "ok" if response.ok else "degraded",
+            "http_status": response.status_code
+        }
+    except Exception as e:
+        return "hh_api", {"status": "error", "detail": str(e)}
+
+HEALTH_CACHE_TTL = 5.0  # Сколько секунд отдавать закэшированный результат /health
+
+# Кэш ответа /health: при шторме probe-запросов внешние проверки
+# выполняются не чаще раза в HEALTH_CACHE_TTL
+_health_cache = {"ts": 0.0, "value": None}
+_health_lock = asyncio.Lock()
+
 @app.get("/health")
-async def health_check():
-    # Очищаем устаревшие записи из кэша
-    with cache_lock:
-        expired_keys = [k for k, v in description_cache.items() if v.is_expired()]
-        for key in expired_keys:
-            del description_cache[key]
-        
-        cache_size = len(description_cache)
-    
+async def health_check(fresh: bool = False):
+    if not fresh:
+        if time.monotonic() - _health_cache["ts"] < HEALTH_CACHE_TTL and _health_cache["value"] is not None:
+            return _health_cache["value"]
+
+    async with _health_lock:
+        # Перепроверяем после захвата: параллельный вызов мог уже обновить кэш
+        if not fresh:
+            if time.monotonic() - _health_cache["ts"] < HEALTH_CACHE_TTL and _health_cache["value"] is not None:
+                return _health_cache["value"]
+        result = await compute_health()
+        _health_cache["value"] = result
+        _health_cache["ts"] = time.monotonic()
+        return result
+
+async def compute_health():
+    # Не сканируем весь кэш на каждую проверку (healthcheck дергает endpoint
+    # каждые 30 секунд) - размер читаем за O(1), чистку делает /cache/stats
+    cache_size = len(description_cache)
+
+    # Все внешние проверки запускаются параллельно: общее время ответа -
+    # max по probe, а не сумма (и каждая ограничена своим таймаутом)
+    results = await asyncio.gather(check_hh_api(), return_exceptions=True)
+    checks = {}
+    for item in results:
+        if isinstance(item, BaseException):
+            checks["internal"] = {"status": "error", "detail": str(item)}
+        else:
+            name, check = item
+            checks[name] = check
+
+    degraded = any(c.get("status") != "ok" for c in checks.values())
+
     return {
-        "status": "healthy",
+        "status": "degraded" if degraded else "healthy",
         "timestamp": datetime.now().isoformat(),
+        "checks": checks,
         "cache_size": cache_size,
-        "cache_ttl_hours": CACHE_TTL_HOURS
+        "cache_ttl_hours": CACHE_TTL_HOURS,
+        "websockets": manager.stats(),
+        "process": {
+            "memory_rss_mb": round(_PROCESS.memory_info().rss / (1024 * 1024), 1),
+            "cpu_percent": _PROCESS.cpu_percent(interval=None),
+            "num_threads": _PROCESS.num_threads()
+        }
     }
 
+async def watch_disconnect(websocket: WebSocket):
+    """Ждет отключения клиента, чтобы можно было отменить анализ"""
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+
 @app.websocket("/ws/analyze")
 async def websocket_analyze(websocket: WebSocket):
     """WebSocket endpoint для анализа с прогрессом в реальном времени"""
-    await manager.connect(websocket)
+    connection_id = await manager.connect(websocket)
+    # Адрес клиента вычисляется один раз на соединение и переиспользуется
+    # во всех записях лога
+    client_host = websocket.client.host if websocket.client else "-"
+    logger.info("WebSocket %s подключен (%s)", connection_id, client_host)
     try:
-        # Получаем параметры запроса
-        data = await websocket.receive_json()
-        
-        vacancy_title = data.get('vacancy_title')
-        technology = data.get('technology')
-        exact_search = data.get('exact_search', True)
-        area = data.get('area', 113)
-        max_pages = data.get('max_pages', 10)
+        # Получаем параметры запроса; схема VacancySearchRequest проверяет
+        # типы и диапазоны полей один раз на границе вместо россыпи
+        # data.get с неявными предположениями о типах.
+        # receive_text + orjson вместо receive_json: декодер stdlib json
+        # не участвует ни в одном направлении обмена
+        data = orjson.loads(await websocket.receive_text())
+        request = VacancySearchRequest.model_validate(data)
+
+        vacancy_title = request.vacancy_title
+        technology = request.technology
+        exact_search = request.exact_search
+        area = request.area
+        max_pages = request.max_pages
 
         global MAX_WORKERS, REQUEST_DELAY, MAX_REQUESTS_PER_SECOND, CACHE_TTL_HOURS
-        MAX_WORKERS = data.get('max_workers', MAX_WORKERS)
-        REQUEST_DELAY = data.get('request_delay', REQUEST_DELAY)
-        MAX_REQUESTS_PER_SECOND = data.get('max_requests_per_second', MAX_REQUESTS_PER_SECOND)
-        CACHE_TTL_HOURS = data.get('cache_ttl_hours', CACHE_TTL_HOURS)
-        
+        # Переопределения уже провалидированы моделью (ge/le), дальше
+        # горячие пути читают их как обычные глобальные переменные
+        if request.max_workers is not None:
+            MAX_WORKERS = request.max_workers
+        if request.request_delay is not None:
+            REQUEST_DELAY = request.request_delay
+        if request.max_requests_per_second is not None:
+            MAX_REQUESTS_PER_SECOND = request.max_requests_per_second
+        if request.cache_ttl_hours is not None:
+            CACHE_TTL_HOURS = request.cache_ttl_hours
+
         # Формируем поисковый запрос
         if exact_search:
             search_query = f'"{vacancy_title}"'
         else:
             search_query = vacancy_title
-        
-        try:
-            # Получаем вакансии с прогрессом
-            vacancies = await get_vacancies_with_progress(search_query, area, max_pages, websocket)
-            
-            if not vacancies:
+
+        async def run_analysis():
+            try:
+                if analysis_semaphore.locked():
+                    await manager.send_payload(_QUEUE_WAIT_PAYLOAD, websocket)
+
+                async with analysis_semaphore:
+                    await _run_analysis_inner()
+            except Exception as e:
+                logger.exception("Ошибка при анализе: %s", e)
                 await manager.send_message({
                     "stage": "error",
-                    "message": "Вакансии не найдены",
+                    "message": f"Ошибка при анализе: {str(e)}",
                     "progress": 0
                 }, websocket)
+
+        async def _run_analysis_inner():
+            # Получаем вакансии с прогрессом
+            vacancies = await get_vacancies_with_progress(search_query, area, max_pages, websocket)
+
+            if not vacancies:
+                await manager.send_payload(_NO_VACANCIES_PAYLOAD, websocket)
                 return
-            
+
             # Анализируем вакансии с прогрессом
             stats = await analyze_vacancies_with_progress(vacancies, technology, websocket)
-            
+
             # Отправляем финальный результат
             real_requests, cached_requests = get_request_count()
-            
+
             result = {
                 "stage": "finished",
                 "data": {
@@ -507,26 +883,28 @@ async def websocket_analyze(websocket: WebSocket):
                 },
                 "progress": 100
             }
-            
+
             await manager.send_message(result, websocket)
-            
-        except Exception as e:
-            print(f"Ошибка при анализе: {e}")
-            import traceback
-            traceback.print_exc()
-            await manager.send_message({
-                "stage": "error",
-                "message": f"Ошибка при анализе: {str(e)}",
-                "progress": 0
-            }, websocket)
-        
+
+        # Запускаем анализ и наблюдателя за отключением в одной группе задач:
+        # отключение клиента отменяет анализ, чтобы не тратить запросы впустую
+        try:
+            async with asyncio.TaskGroup() as tg:
+                watcher = tg.create_task(watch_disconnect(websocket))
+                analysis = tg.create_task(run_analysis())
+                analysis.add_done_callback(lambda _: watcher.cancel())
+        except* WebSocketDisconnect:
+            raise WebSocketDisconnect(1000)
+
+        # Штатное завершение: close() дожидается, пока писатель дошлет
+        # оставшиеся в очереди кадры (включая финальный результат),
+        # прежде чем disconnect() отменит его
+        await manager.close(websocket)
+
     except WebSocketDisconnect:
-        print("WebSocket отключен пользователем")
-        manager.disconnect(websocket)
+        logger.info("WebSocket %s (%s) отключен пользователем", connection_id, client_host)
     except Exception as e:
-        print(f"Ошибка WebSocket: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Ошибка WebSocket %s (%s): %s", connection_id, client_host, e)
         try:
             await manager.send_message({
                 "stage": "error",
@@ -535,28 +913,30 @@ async def websocket_analyze(websocket: WebSocket):
             }, websocket)
         except:
             pass
+        await manager.close(websocket, code=1011)
     finally:
         manager.disconnect(websocket)
 
+CACHE_STATS_TTL = 0.5  # Секунды; частый опрос статистики не запускает обход кэша
+
+# Мемоизация ответа /cache/stats: дашборд может опрашивать endpoint
+# несколько раз в секунду, обход кэша при этом делается не чаще TTL
+_cache_stats_memo = {"ts": 0.0, "value": None}
+
 @app.get("/cache/stats")
 async def get_cache_statistics():
     """Получить статистику кэша"""
+    if time.monotonic() - _cache_stats_memo["ts"] < CACHE_STATS_TTL and _cache_stats_memo["value"] is not None:
+        return _cache_stats_memo["value"]
+
     real_requests, cached_requests = get_request_count()
     total = real_requests + cached_requests
     
-    with cache_lock:
-        # Очищаем устаревшие записи
-        expired_keys = [k for k, v in description_cache.items() if v.is_expired()]
-        for key in expired_keys:
-            del description_cache[key]
-        
-        cache_size = len(description_cache)
-        
-        # Считаем сколько записей истекут в ближайшее время
-        expiring_soon = sum(1 for v in description_cache.values() 
-                          if (datetime.now() - v.timestamp) > timedelta(hours=CACHE_TTL_HOURS - 1))
+    # Чистка и агрегаты за один проход - без отдельного снимка всех
+    # записей только ради подсчета
+    cache_size, expiring_soon = evict_expired_entries()
     
-    return {
+    result = {
         "cache_size": cache_size,
         "real_requests": real_requests,
         "cached_requests": cached_requests,
@@ -565,21 +945,93 @@ async def get_cache_statistics():
         "cache_ttl_hours": CACHE_TTL_HOURS,
         "expiring_soon": expiring_soon
     }
+    _cache_stats_memo["value"] = result
+    _cache_stats_memo["ts"] = time.monotonic()
+    return result
+
+@app.get("/cache/entries")
+async def get_cache_entries(offset: int = 0, limit: int = 50):
+    """Постраничный список записей кэша (для отладки работы кэша)"""
+    # Ограничиваем размер страницы на сервере, offset/limit применяются
+    # прямо при обходе кэша - не материализуем все записи ради одной страницы
+    limit = min(max(limit, 1), 100)
+    offset = max(offset, 0)
+    now = time.monotonic()
+
+    with cache_lock:
+        total = len(description_cache)
+        page = [
+            {
+                "vacancy_id": vacancy_id,
+                "age_seconds": round(now - entry.timestamp, 1),
+                "description_length": len(entry.data)
+            }
+            for vacancy_id, entry in itertools.islice(description_cache.items(), offset, offset + limit)
+        ]
+
+    return {
+        "data": page,
+        "total": total,
+        "limit": limit,
+        "offset": offset,
+        "has_more": offset + limit < total
+    }
+
+@app.get("/cache/export")
+async def export_cache():
+    """Выгрузка всего кэша описаний одним потоком"""
+    # StreamingResponse + поэлементная сериализация: ответ не собирается
+    # целиком в памяти, первые байты уходят клиенту сразу
+    def generate():
+        with cache_lock:
+            items = list(description_cache.items())  # быстрый снимок под блокировкой
+        yield b'{"entries":['
+        now = time.monotonic()
+        for i, (vacancy_id, entry) in enumerate(items):
+            row = orjson.dumps({
+                "vacancy_id": vacancy_id,
+                "age_seconds": round(now - entry.timestamp, 1),
+                "description": entry.data
+            })
+            yield b',' + row if i else row
+        yield b'],"total":' + str(len(items)).encode() + b'}'
+
+    return StreamingResponse(generate(), media_type="application/json")
 
-@app.delete("/cache/clear")
+@app.delete("/cache/clear", dependencies=[Depends(verify_admin_token)])
 async def clear_cache():
     """Очистить кэш"""
     with cache_lock:
         cache_size = len(description_cache)
         description_cache.clear()
-    
+
     reset_request_counters()
-    
+    # Сбрасываем мемоизацию статистики: после очистки она заведомо устарела,
+    # иначе /cache/stats еще до TTL отдавал бы данные удаленного кэша
+    _cache_stats_memo["ts"] = 0.0
+    _cache_stats_memo["value"] = None
+
     return {
         "message": "Кэш успешно очищен",
         "cleared_items": cache_size
     }
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    logging.basicConfig(level=logging.INFO)
+    # uvloop и httptools (из uvicorn[standard]) заметно быстрее event loop
+    # и http-парсера из стандартной библиотеки.
+    # Keepalive - протокольными ping/pong кадрами на уровне сервера:
+    # зависшие клиенты отваливаются без таймеров в коде приложения
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        ws_ping_interval=20.0,
+        ws_ping_timeout=20.0,
+        # Кадры прогресса маленькие: zlib-состояние permessage-deflate на
+        # каждое сообщение стоит дороже, чем экономия трафика
+        ws_per_message_deflate=False
+    )
     
\ No newline at end of file